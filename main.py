@@ -1,16 +1,18 @@
 #!/usr/bin/env python
 
 import json
-import math
 import os
 from pathlib import Path
 import subprocess
 import logging
 import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import ffmpeg
 from makemkv import MakeMKV, ProgressParser, MakeMKVError
-from tvdb_v4_official import TVDB
+from tvdb_v4_official import TVDB, Auth, Request, Url
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,45 +20,75 @@ logger = logging.getLogger(__name__)
 API_KEY = os.environ.get('API_KEY')
 API_PIN = os.environ.get('API_PIN')
 
-j = '''[
-  "--ui-language",
-  "en_US",
-  "--output",
-  "{output}",
-  "--language",
-  "0:en",
-  "--display-dimensions",
-  "0:{display_dimensions}",
-  "--language",
-  "1:en",
-  "--track-name",
-  "1:Surround 5.1",
-  "--language",
-  "2:ja",
-  "--track-name",
-  "2:Stereo",
-  "--language",
-  "3:en",
-  "--language",
-  "4:en",
-  "(",
-  "{input}",
-  ")",
-  "--split",
-  "chapters:{chapters}",
-  "--track-order",
-  "0:0,0:1,0:2,0:3,0:4"
-]
-'''
+CACHE_DIR = Path('~/.cache/one-piece-ripper').expanduser()
+CACHE_TTL = 7 * 24 * 60 * 60
+TOKEN_TTL = 24 * 60 * 60
+TOKEN_FILE = CACHE_DIR / 'tvdb-token.json'
+PAGE_WORKERS = 4
+
+# End credits run ~30s, chapter timings are in nanoseconds
+CREDITS_MIN_NS = 29 * 1000000000
+CREDITS_MAX_NS = 32 * 1000000000
 
 
 def main():
     base_dir, start_number = parse_args()
-    mkv_fname, chapter_markers, disc_name, drive = rip_disc(base_dir)
-    episodes = split_episodes(mkv_fname, chapter_markers)
-    rename_episodes(base_dir, disc_name, episodes, start_number)
-    os.system(f'umount {drive}')
-    os.system(f'eject {drive}')
+    # Splitting and renaming a disc happens in the background so the next disc can be ripped
+    # in the meantime, a single worker keeps the discs in order
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        previous = None
+        while True:
+            mkv_fname, chapter_markers, disc_name, drive = rip_disc(base_dir)
+            subprocess.run(['umount', drive], check=False)
+            subprocess.run(['eject', drive], check=False)
+            previous = executor.submit(process_disc, base_dir, mkv_fname, chapter_markers,
+                                       disc_name, start_number, previous)
+            if disc_failed(previous):
+                break
+            if input('Insert the next disc and press enter, or enter "q" to quit: ') == 'q':
+                break
+            if disc_failed(previous):
+                break
+        previous.result()
+
+
+def disc_failed(future: Future) -> bool:
+    """
+    Checks if processing a disc in the background has failed, every disc after it would fail too
+    as it needs the episode number the failed disc ends on.
+
+    :param future: Future of the disc being processed
+    :return: True if processing the disc failed
+    """
+    if future.done() and future.exception() is not None:
+        logger.error(f'Failed to process the previous disc: {future.exception()}')
+        return True
+    return False
+
+
+def process_disc(base_dir: Path, mkv_fname: str, chapter_markers: list[int], disc_name: str,
+                 start_number: int, previous: Future | None) -> int:
+    """
+    Splits and renames the episodes of a disc that has already been ripped. The first episode of
+    a disc follows on from the last episode of the previous one, so we wait on that to finish.
+
+    :param base_dir: Base directory for files
+    :param mkv_fname: Filename of the ripped MKV
+    :param chapter_markers: What chapters to split it on
+    :param disc_name: Name of the disc so we can find the subdir
+    :param start_number: First episode number in absolute numbering, used for the first disc
+    :param previous: Future of the previous disc, None for the first disc
+    :return: The episode number the next disc starts on
+    """
+    starting_episode = previous.result() if previous else start_number
+    # Pull the listings from TVDB while mkvmerge is busy splitting the disc
+    # If the disc had no segments we only know how many episodes there are after splitting
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        listings = executor.submit(fetch_listings, starting_episode - 1, len(chapter_markers) or None)
+        episodes = split_episodes(mkv_fname, chapter_markers)
+        eps_abs, all_episodes = listings.result()
+    rename_episodes(base_dir, disc_name, episodes, eps_abs, all_episodes)
+    return starting_episode + len(episodes)
 
 
 def parse_args() -> tuple[Path, int]:
@@ -74,21 +106,32 @@ def rip_disc(base_dir: Path) -> tuple[str, list[int], str, str]:
     to gather some information about it before ripping it to disk as an MKV. This MKV
     contains all episodes on the disc, sorted by chapters, and contains the data on how the
     episodes are divided into chapters which we also return. Finally, just some metadata on
-    the name of the disc, and where it was mounted.
+    the name of the disc, and where it was mounted. Discs are ripped into a directory named after
+    the disc, with a number appended if that directory already exists.
 
     :param base_dir: Base directory to store files
-    :return: MKV filename, Episode divisions by chapters, Name of disc, Where disc is mounted
+    :return: MKV filename, Episode divisions by chapters, Name of the directory the disc was ripped
+     into, Where disc is mounted
     """
     with ProgressParser() as progress:
         mkv = MakeMKV(0, progress_handler=progress.parse_progress)
         logger.info('Reading info from disc')
         info = mkv.info()
         disc_name = info['disc']['name']
-        output_dir = Path(f'{base_dir}/{disc_name}')
         drive = info['drives'][0]['device_path']
         title = find_largest_title(info['titles'])
         chapter_markers = find_segments(info['titles'][title])
-        output_dir.mkdir(exist_ok=True)
+        # The previous disc may still be processing, so never rip into a directory that exists
+        output_dir = base_dir / disc_name
+        n = 1
+        while True:
+            try:
+                output_dir.mkdir()
+                break
+            except FileExistsError:
+                n += 1
+                output_dir = base_dir / f'{disc_name} ({n})'
+        disc_name = output_dir.name
         try:
             logger.info('Ripping disc, this may take some time')
             mkv.mkv(title, str(output_dir))
@@ -109,25 +152,10 @@ def find_segments(title) -> list[int]:
     :param title: Title metadata
     :return: list of chapters to split on
     """
-    segments = []
     chapter_count = title['chapter_count']
-    for s in title['segments_map'].split(','):
-        segment = 0
-        if '-' in s:
-            segment = int(s.split('-')[0])
-        else:
-            segment = int(s)
-
-        if 0 < segment <= chapter_count:
-            segments.append(segment)
-
-    # Remove value 1 from list, as we want to split AFTER the first episode not before
-    try:
-        segments.remove(1)
-    except ValueError:
-        logger.debug('Did not find a segment with "1"')
-
-    return segments
+    segments = (int(s.partition('-')[0]) for s in title['segments_map'].split(','))
+    # Skip 1 as well, as we want to split AFTER the first episode not before
+    return [segment for segment in segments if 1 < segment <= chapter_count]
 
 
 def find_largest_title(titles: list) -> int:
@@ -138,57 +166,75 @@ def find_largest_title(titles: list) -> int:
     :return: Title number with the episodes
     """
     logger.info('Finding largest title')
-    largest = {'title': 0, 'size': 0}
-    for i, title in enumerate(titles):
-        size = title['size']
-        if size > largest['size']:
-            largest['size'] = size
-            largest['title'] = i
-
-    logger.info(f'Found {largest["title"]} with size {titles[largest["title"]]["size_human"]}')
-    return largest['title']
+    largest = max(range(len(titles)), key=lambda i: titles[i]['size'])
+    logger.info(f'Found {largest} with size {titles[largest]["size_human"]}')
+    return largest
 
 
 def split_episodes(mkv_fname: str, chapter_markers: list[int]) -> list[str]:
     """
-    Splits up the episodes based on the given chapter markers using `mkvmerge`. We skip generating
-    the command and just use json input. This is mainly because I'm too lazy to try and properly
-    figure out how to build the command, and this json was pulled from MKVToolNix then templated
-    to work, this is likely brittle.
+    Splits up the episodes based on the given chapter markers using `mkvmerge`. The arguments are
+    hard coded for the One Piece discs, see `build_mkvmerge_args`, this is likely brittle.
 
     :param mkv_fname: Filename of the MKV to split
     :param chapter_markers: What chapters to split it on
     :return: A list of filenames we just created
     """
     logger.info(f'Splitting {mkv_fname} into episodes')
+    # The episodes are written next to the ripped MKV so everything stays on one filesystem, we
+    # cannot skip the intermediate file by piping MakeMKV in as mkvmerge needs a seekable input
     ppath = str(Path(mkv_fname).parent) + '/'
-    json_path = ppath + 'mkvmerge.json'
     output = ppath + 'episode.mkv'
 
-    probe = ffmpeg.probe(mkv_fname, show_chapters=None)
-    display_dimensions = probe['streams'][0]['display_aspect_ratio'].replace(':', 'x')
+    identify = subprocess.run(['mkvmerge', '-J', mkv_fname], check=True, capture_output=True)
+    tracks = json.loads(identify.stdout)['tracks']
+    video = next(t for t in tracks if t['type'] == 'video')
+    display_dimensions = video['properties']['display_dimensions']
     if len(chapter_markers) == 0:
+        # mkvmerge does not report chapter timings, so fall back to ffprobe for those
+        probe = ffmpeg.probe(mkv_fname, select_streams='v:0', show_chapters=None)
         chapter_markers = find_credits(probe['chapters'])
     chapter_string = ','.join(map(str, chapter_markers))
 
-    payload = json.loads(j.format(output=output, input=mkv_fname, chapters=chapter_string,
-                                  display_dimensions=display_dimensions))
-    with open(json_path, 'w') as f:
-        json.dump(payload, f, indent=4)
-
-    subprocess.run(['mkvmerge', f'@{json_path}'], check=True, capture_output=True)
+    args = build_mkvmerge_args(output, mkv_fname, chapter_string, display_dimensions)
+    subprocess.run(['mkvmerge', *args], check=True, capture_output=True)
     try:
         os.remove(ppath + 'episode-{:>03}.mkv'.format(len(chapter_markers) + 1))
     except FileNotFoundError:
         logger.info("No trailing clip to remove")
 
     os.remove(mkv_fname)
-    os.remove(json_path)
 
-    files = []
-    for i in range(1, len(chapter_markers)+1):
-        files.append(f'episode-{i:>03}.mkv')
-    return files
+    return [f'episode-{i:>03}.mkv' for i in range(1, len(chapter_markers)+1)]
+
+
+def build_mkvmerge_args(output: str, input_fname: str, chapters: str,
+                        display_dimensions: str) -> list[str]:
+    """
+    Builds the `mkvmerge` arguments for splitting the disc MKV, these were pulled from the json
+    MKVToolNix generates and set the track languages and names along with the split points.
+
+    :param output: Output filename, mkvmerge will number each split file
+    :param input_fname: Filename of the MKV to split
+    :param chapters: Comma separated list of chapters to split on
+    :param display_dimensions: Display dimensions of the video track, e.g. 853x480
+    :return: List of arguments to pass to mkvmerge
+    """
+    return [
+        '--ui-language', 'en_US',
+        '--output', output,
+        '--language', '0:en',
+        '--display-dimensions', f'0:{display_dimensions}',
+        '--language', '1:en',
+        '--track-name', '1:Surround 5.1',
+        '--language', '2:ja',
+        '--track-name', '2:Stereo',
+        '--language', '3:en',
+        '--language', '4:en',
+        '(', input_fname, ')',
+        '--split', f'chapters:{chapters}',
+        '--track-order', '0:0,0:1,0:2,0:3,0:4',
+    ]
 
 
 def find_credits(chapters: dict) -> list[int]:
@@ -201,74 +247,282 @@ def find_credits(chapters: dict) -> list[int]:
     """
     episode_markers = []
     for i, chapter in enumerate(chapters):
-        d = math.floor((chapter['end'] - chapter['start']) / 1000000000)
-        if 28 < d < 32:
-            end = i+2
-            logger.info(f'Found end credits -- {chapter["tags"]["title"]} - {d}s')
-            episode_markers.append(end)
+        d = chapter['end'] - chapter['start']
+        if CREDITS_MIN_NS <= d < CREDITS_MAX_NS:
+            logger.info(f'Found end credits -- {chapter["tags"]["title"]} - {d // 1000000000}s')
+            episode_markers.append(i+2)
 
     logger.info(f'Found {len(episode_markers)} episodes')
     return episode_markers
 
 
-def rename_episodes(directory: Path, disc_name: str, episodes: list[str], starting_episode: int):
+def rename_episodes(directory: Path, disc_name: str, episodes: list[str], eps_abs: list[dict],
+                    all_episodes: list[dict]):
     """
-    Remanes and moves the episodes into their season directory. Using the start episode from
-    the CLI arguments, we find that episode on TVDB using absolute (this number is on the physical
-    disc and case) then we take that ID and look it up using the air date listings which Plex
-    is happier with. We then put it into the format "$show - S$seasonE$episode - $title"
+    Remanes and moves the episodes into their season directory. The episodes on the disc are given
+    in absolute order (this number is on the physical disc and case), we take their IDs and look
+    them up in the air date listing which Plex is happier with. We then put it into the format
+    "$show - S$seasonE$episode - $title"
 
     This method cleans up everything when finished, not ideal, but it is convenient
 
     :param directory: Base directory for files
     :param disc_name: Name of the disc so we can find the subdir
     :param episodes: List of episode names to be renamed
-    :param starting_episode: What is the first episode on the disc in absolute episode numbering
+    :param eps_abs: Episodes in absolute order, starting with the first episode on the disc
+    :param all_episodes: All episodes in default (aired) order
     """
-    start = starting_episode-1
-    end = start+len(episodes)
-    tvdb = TVDB(API_KEY, API_PIN)
-    all_episodes_abs = fetch_all_episodes(tvdb, 'absolute')
-    all_episodes = fetch_all_episodes(tvdb)
-    eps_abs = all_episodes_abs[start:end]
-    disc_dir = Path(f'{directory}/{disc_name}')
+    eps_abs = eps_abs[:len(episodes)]
+    disc_dir = directory / disc_name
 
     # Translate the absolute numbers to "seasons" to make Plex happy
-    my_eps = []
-    for e in eps_abs:
-        my_eps.append(list(filter(lambda ep: ep['id'] == e['id'], all_episodes))[0])
+    episodes_by_id = {ep['id']: ep for ep in all_episodes}
+    my_eps = [episodes_by_id[e['id']] for e in eps_abs]
+
+    for season in {ep['seasonNumber'] for ep in my_eps}:
+        (directory / f'Season {season}').mkdir(exist_ok=True)
 
     for i, e in enumerate(episodes):
         episode = my_eps[i]
         season = episode['seasonNumber']
         episode_number = episode['number']
         title = episode['name']
-        season_dir = Path(f'{directory}/Season {season}')
+        season_dir = directory / f'Season {season}'
         fname = f'One Piece - S{season:>02}E{episode_number:>02} - {title}.mkv'
 
-        src = f'{disc_dir}/{e}'
-        dst = f'{season_dir}/{fname}'
-        season_dir.mkdir(exist_ok=True)
+        src = disc_dir / e
+        dst = season_dir / fname
         logger.info(f'Renaming {src} to {dst}')
         os.rename(src, dst)
 
     os.rmdir(disc_dir)
 
 
-def fetch_all_episodes(tvdb: TVDB, season_type='default') -> list[dict]:
+class CachedTVDB(TVDB):
+    """
+    TVDB client that reuses the login token from previous runs for `TOKEN_TTL` seconds, saving
+    the login round trip. If the token is rejected we log in again and retry.
+    """
+
+    def __init__(self, apikey: str, pin=''):
+        cached = read_cache(TOKEN_FILE, TOKEN_TTL)
+        if cached is None:
+            super().__init__(apikey, pin)
+            token = self.auth.get_token()
+            write_cache(TOKEN_FILE, {'token': token}, mode=0o600)
+        else:
+            # `TVDB.__init__` always logs in, so we only repeat its url setup here
+            logger.debug(f'Using cached TVDB token from {TOKEN_FILE}')
+            self.url = Url()
+            self.auth = None
+            token = cached['token']
+        self.request = RetryRequest(token, lambda: self.login(apikey, pin))
+
+    def login(self, apikey: str, pin: str) -> str:
+        """
+        Logs in to TVDB and caches the token for the next run.
+
+        :param apikey: TVDB API key
+        :param pin: TVDB subscriber pin
+        :return: The new auth token
+        """
+        self.auth = Auth(self.url.construct('login'), apikey, pin)
+        token = self.auth.get_token()
+        write_cache(TOKEN_FILE, {'token': token}, mode=0o600)
+        return token
+
+
+class RetryRequest(Request):
+    """
+    Request that logs in again and retries once when TVDB rejects the auth token, as a cached
+    token may have expired or been revoked. It is shared by the fetch threads, so logging in is
+    guarded by a lock and only happens once per rejected token.
+    """
+
+    def __init__(self, auth_token: str, login):
+        super().__init__(auth_token)
+        self.login = login
+        self.lock = threading.Lock()
+
+    def make_request(self, url, if_modified_since=None):
+        token = self.auth_token
+        try:
+            return super().make_request(url, if_modified_since)
+        except ValueError as e:
+            # The client only gives us the message, TVDB answers a bad token with "Unauthorized"
+            if 'unauthorized' not in str(e).lower():
+                raise
+            with self.lock:
+                if self.auth_token == token:
+                    logger.info('TVDB rejected the auth token, logging in again')
+                    self.auth_token = self.login()
+            return super().make_request(url, if_modified_since)
+
+
+def fetch_listings(start: int, count: int | None) -> tuple[list[dict], list[dict]]:
+    """
+    Fetches the episodes on the disc in absolute order, and the full default episode listing from
+    TVDB. The TVDB client is blocking, so both listings are fetched side by side in threads.
+
+    :param start: Index of the first episode on the disc in absolute order
+    :param count: How many episodes are on the disc, None if we do not know yet
+    :return: Episodes in absolute order starting at `start`, All episodes in default order
+    """
+    tvdb = CachedTVDB(API_KEY, API_PIN)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        abs_future = executor.submit(fetch_episode_window, tvdb, start, count, 'absolute')
+        default_future = executor.submit(fetch_all_episodes, tvdb)
+        return abs_future.result(), default_future.result()
+
+
+def fetch_episode_window(tvdb: TVDB, start: int, count: int | None, season_type='default',
+                         series_id=81797) -> list[dict]:
+    """
+    Fetches `count` episodes starting at index `start`. Pages are ordered, so once the first page
+    tells us the page size we can go straight to the page holding `start` rather than pulling the
+    whole listing. Each page is cached on disk for `CACHE_TTL` seconds.
+
+    :param tvdb: TVDB object to pull API data from
+    :param start: Index of the first episode we want
+    :param count: How many episodes we want, None for everything from `start` onwards
+    :param season_type: default, absolute, dvd
+    :param series_id: TVDB ID of the series, defaults to One Piece
+    :return: A list of episode metadata
+    """
+    def fetch_page(page: int) -> list[dict]:
+        cache_file = episode_cache_file(series_id, season_type, page)
+        cached = read_cache(cache_file, CACHE_TTL)
+        if cached is not None:
+            logger.info(f'Using cached {season_type} episode page from {cache_file}')
+            return cached
+        eps = fetch_episode_page(tvdb, series_id, season_type, page)
+        write_cache(cache_file, eps)
+        return eps
+
+    page_size = len(fetch_page(0))
+    if page_size == 0:
+        return []
+    page, offset = divmod(start, page_size)
+    wanted = None if count is None else offset + count
+    episodes = []
+    while wanted is None or len(episodes) < wanted:
+        eps = fetch_page(page)
+        episodes.extend(eps)
+        if len(eps) < page_size:
+            break
+        page += 1
+    return episodes[offset:wanted]
+
+
+def fetch_all_episodes(tvdb: TVDB, season_type='default', series_id=81797,
+                       max_pages=100) -> list[dict]:
     """
     Fetches all episodes from TVDB, we need to vary the `season_type` so it is here to allow that.
+    The listing is cached on disk for `CACHE_TTL` seconds, as paging through a show with 1000+
+    episodes is slow and the results rarely change between discs.
 
     :param tvdb: TVDB object to pull API data from
     :param season_type: default, absolute, dvd
+    :param series_id: TVDB ID of the series, defaults to One Piece
+    :param max_pages: Upper bound on how many pages we will request
     :return: A list of all episode metadata
     """
-    episodes = []
-    for i in range(0, 100):
-        one_piece_page = tvdb.get_series_episodes(81797, lang='eng', season_type=season_type, page=i)
-        if len(one_piece_page['episodes']) == 0:
-            return episodes
-        episodes.extend(one_piece_page['episodes'])
+    cache_file = episode_cache_file(series_id, season_type)
+    cached = read_cache(cache_file, CACHE_TTL)
+    if cached is not None:
+        logger.info(f'Using cached {season_type} episode listing from {cache_file}')
+        return cached
+
+    def fetch_page(page: int) -> list[dict]:
+        return fetch_episode_page(tvdb, series_id, season_type, page)
+
+    # The first page tells us the page size, any page shorter than that is the last one so we
+    # do not need to probe for an empty page afterwards
+    episodes = fetch_page(0)
+    page_size = len(episodes)
+    if page_size > 0:
+        with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+            for chunk_start in range(1, max_pages, PAGE_WORKERS):
+                chunk = range(chunk_start, min(chunk_start + PAGE_WORKERS, max_pages))
+                done = False
+                for page in executor.map(fetch_page, chunk):
+                    episodes.extend(page)
+                    if len(page) < page_size:
+                        done = True
+                        break
+                if done:
+                    break
+
+    write_cache(cache_file, episodes)
+    return episodes
+
+
+def fetch_episode_page(tvdb: TVDB, series_id: int, season_type: str, page: int) -> list[dict]:
+    """
+    Fetches one page of episodes from TVDB.
+
+    :param tvdb: TVDB object to pull API data from
+    :param series_id: TVDB ID of the series
+    :param season_type: default, absolute, dvd
+    :param page: Page number, starting at 0
+    :return: The episodes on the page, empty past the last page
+    """
+    # `get_series_extended(meta=...)` would return everything in one call, but its episode records
+    # only carry the original language names, so we stick with the paged, language aware listing
+    return tvdb.get_series_episodes(series_id, lang='eng', season_type=season_type,
+                                    page=page)['episodes']
+
+
+def episode_cache_file(series_id: int, season_type: str, page: int | None = None) -> Path:
+    """
+    Where the episode listing for a series and season type is cached, either the full listing
+    or a single page of it.
+
+    :param series_id: TVDB ID of the series
+    :param season_type: default, absolute, dvd
+    :param page: Page number, None for the full listing
+    :return: Path to the cache file
+    """
+    if page is None:
+        return CACHE_DIR / f'{series_id}-{season_type}.json'
+    return CACHE_DIR / f'{series_id}-{season_type}-{page}.json'
+
+
+def read_cache(cache_file: Path, ttl: int):
+    """
+    Reads JSON data from the cache file if it is younger than `ttl`.
+
+    :param cache_file: Where the data is stored
+    :param ttl: How many seconds the data is valid for
+    :return: The cached data, or None if it is missing, stale or unreadable
+    """
+    try:
+        if time.time() - cache_file.stat().st_mtime < ttl:
+            with open(cache_file) as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        logger.debug(f'No usable cache at {cache_file}')
+    return None
+
+
+def write_cache(cache_file: Path, data, mode=0o644):
+    """
+    Writes `data` as JSON to the cache file. We write to a temp file first and swap it in so a
+    crash mid-write never leaves a truncated cache behind.
+
+    :param cache_file: Where to store the data
+    :param data: JSON serializable data to store
+    :param mode: File permissions, for anything sensitive like tokens
+    """
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_file.with_suffix('.tmp')
+        with open(tmp, 'w', opener=lambda path, flags: os.open(path, flags, mode)) as f:
+            json.dump(data, f)
+        os.chmod(tmp, mode)
+        os.replace(tmp, cache_file)
+    except OSError as e:
+        logger.warning(f'Failed to write cache {cache_file}: {e}')
 
 
 if __name__ == '__main__':